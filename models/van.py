@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import copy
 from functools import partial
 
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
@@ -8,6 +9,19 @@ from timm.models.registry import register_model
 from timm.models.vision_transformer import _cfg
 import math
 
+class LayerNorm2d(nn.LayerNorm):
+    """ LayerNorm over the channel dim of (B, C, H, W) tensors, output keeps the input memory format
+    """
+
+    def forward(self, x):
+        if x.is_contiguous(memory_format=torch.channels_last):
+            memory_format = torch.channels_last
+        else:
+            memory_format = torch.contiguous_format
+        x = F.layer_norm(x.permute(0, 2, 3, 1), self.normalized_shape, self.weight, self.bias, self.eps)
+        return x.permute(0, 3, 1, 2).contiguous(memory_format=memory_format)
+
+
 class Mlp(nn.Module):
     def __init__(self, in_features, hidden_features=None, out_features=None, act_layer=nn.GELU, drop=0.):
         super().__init__()
@@ -56,25 +70,24 @@ class LKA(nn.Module):
 
 
     def forward(self, x):
-        u = x.clone()        
         attn = self.conv0(x)
         attn = self.conv_spatial(attn)
         attn = self.conv1(attn)
 
-        return u * attn
+        return x * attn
 
 
 class Attention(nn.Module):
-    def __init__(self, d_model):
+    def __init__(self, d_model, act_layer=nn.GELU):
         super().__init__()
 
         self.proj_1 = nn.Conv2d(d_model, d_model, 1)
-        self.activation = nn.GELU()
+        self.activation = act_layer()
         self.spatial_gating_unit = LKA(d_model)
         self.proj_2 = nn.Conv2d(d_model, d_model, 1)
 
     def forward(self, x):
-        shorcut = x.clone()
+        shorcut = x
         x = self.proj_1(x)
         x = self.activation(x)
         x = self.spatial_gating_unit(x)
@@ -87,7 +100,8 @@ class Block(nn.Module):
     def __init__(self, dim, mlp_ratio=4., drop=0.,drop_path=0., act_layer=nn.GELU):
         super().__init__()
         self.norm1 = nn.BatchNorm2d(dim)
-        self.attn = Attention(dim)
+        self.attn = Attention(dim, act_layer=act_layer)
+        self.drop_path_prob = drop_path
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
 
         self.norm2 = nn.BatchNorm2d(dim)
@@ -116,9 +130,16 @@ class Block(nn.Module):
             if m.bias is not None:
                 m.bias.data.zero_()
 
+    def _add_scaled(self, x, scale, y):
+        scale = scale[None, :, None, None]
+        if self.training and self.drop_path_prob > 0.:
+            return x + self.drop_path(scale * y)
+        # drop path is a no-op here, so scale and residual add run as a single kernel
+        return torch.addcmul(x, scale, y)
+
     def forward(self, x):
-        x = x + self.drop_path(self.layer_scale_1.unsqueeze(-1).unsqueeze(-1) * self.attn(self.norm1(x)))
-        x = x + self.drop_path(self.layer_scale_2.unsqueeze(-1).unsqueeze(-1) * self.mlp(self.norm2(x)))
+        x = self._add_scaled(x, self.layer_scale_1, self.attn(self.norm1(x)))
+        x = self._add_scaled(x, self.layer_scale_2, self.mlp(self.norm2(x)))
         return x
 
 
@@ -159,8 +180,8 @@ class OverlapPatchEmbed(nn.Module):
 
 class VAN(nn.Module):
     def __init__(self, img_size=224, in_chans=3, num_classes=1000, embed_dims=[64, 128, 256, 512],
-                mlp_ratios=[4, 4, 4, 4], drop_rate=0., drop_path_rate=0., norm_layer=nn.LayerNorm,
-                 depths=[3, 4, 6, 3], num_stages=4, flag=False):
+                mlp_ratios=[4, 4, 4, 4], drop_rate=0., drop_path_rate=0., norm_layer=LayerNorm2d,
+                 depths=[3, 4, 6, 3], num_stages=4, act_layer=nn.GELU, flag=False):
         super().__init__()
         if flag == False:
             self.num_classes = num_classes
@@ -178,7 +199,8 @@ class VAN(nn.Module):
                                             embed_dim=embed_dims[i])
 
             block = nn.ModuleList([Block(
-                dim=embed_dims[i], mlp_ratio=mlp_ratios[i], drop=drop_rate, drop_path=dpr[cur + j])
+                dim=embed_dims[i], mlp_ratio=mlp_ratios[i], drop=drop_rate, drop_path=dpr[cur + j],
+                act_layer=act_layer)
                 for j in range(depths[i])])
             norm = norm_layer(embed_dims[i])
             cur += depths[i]
@@ -187,6 +209,9 @@ class VAN(nn.Module):
             setattr(self, f"block{i + 1}", block)
             setattr(self, f"norm{i + 1}", norm)
 
+        # names, not modules: a second registration would duplicate state_dict keys
+        self.stage_names = [(f"patch_embed{i + 1}", f"block{i + 1}", f"norm{i + 1}") for i in range(num_stages)]
+
         # classification head
         self.head = nn.Linear(embed_dims[3], num_classes) if num_classes > 0 else nn.Identity()
 
@@ -210,6 +235,26 @@ class VAN(nn.Module):
     def freeze_patch_emb(self):
         self.patch_embed1.requires_grad = False
 
+    @torch.no_grad()
+    def fuse_for_inference(self):
+        """ Fold BatchNorm2d layers into adjacent convs for inference.
+
+        The patch embedding norm follows its conv, and Block.norm2 precedes the
+        1x1 Mlp.fc1, so both can be absorbed exactly. Block.norm1 also feeds the
+        Attention shortcut and is left untouched.
+        """
+        self.eval()
+        for patch_embed_name, block_name, _ in self.stage_names:
+            patch_embed = getattr(self, patch_embed_name)
+            if isinstance(patch_embed.norm, nn.BatchNorm2d):
+                patch_embed.proj = _fuse_conv_bn(patch_embed.proj, patch_embed.norm)
+                patch_embed.norm = nn.Identity()
+            for blk in getattr(self, block_name):
+                if isinstance(blk.norm2, nn.BatchNorm2d):
+                    blk.mlp.fc1 = _fuse_bn_conv(blk.norm2, blk.mlp.fc1)
+                    blk.norm2 = nn.Identity()
+        return self
+
     @torch.jit.ignore
     def no_weight_decay(self):
         return {'pos_embed1', 'pos_embed2', 'pos_embed3', 'pos_embed4', 'cls_token'}  # has pos_embed may be better
@@ -222,21 +267,16 @@ class VAN(nn.Module):
         self.head = nn.Linear(self.embed_dim, num_classes) if num_classes > 0 else nn.Identity()
 
     def forward_features(self, x):
-        B = x.shape[0]
-
-        for i in range(self.num_stages):
-            patch_embed = getattr(self, f"patch_embed{i + 1}")
-            block = getattr(self, f"block{i + 1}")
-            norm = getattr(self, f"norm{i + 1}")
-            x, H, W = patch_embed(x)
+        for patch_embed_name, block_name, norm_name in self.stage_names:
+            patch_embed = getattr(self, patch_embed_name)
+            block = getattr(self, block_name)
+            norm = getattr(self, norm_name)
+            x, _, _ = patch_embed(x)
             for blk in block:
                 x = blk(x)
-            x = x.flatten(2).transpose(1, 2)
             x = norm(x)
-            if i != self.num_stages - 1:
-                x = x.reshape(B, H, W, -1).permute(0, 3, 1, 2).contiguous()
 
-        return x.mean(dim=1)
+        return x.mean(dim=(2, 3))
 
     def forward(self, x):
         x = self.forward_features(x)
@@ -255,6 +295,64 @@ class DWConv(nn.Module):
         return x
 
 
+def _bn_scale_shift(bn):
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    shift = bn.bias - bn.running_mean * scale
+    return scale, shift
+
+
+def _fuse_conv_bn(conv, bn):
+    """ fold a BatchNorm2d that follows a conv into the conv weight and bias"""
+    scale, shift = _bn_scale_shift(bn)
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, conv.stride,
+                      conv.padding, conv.dilation, conv.groups, bias=True).to(conv.weight)
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+    fused.weight.copy_(conv.weight * scale.reshape(-1, 1, 1, 1))
+    fused.bias.copy_(bias * scale + shift)
+    return fused
+
+
+def _fuse_bn_conv(bn, conv):
+    """ fold a BatchNorm2d that precedes a 1x1 conv into the conv weight and bias"""
+    # with padding, border outputs would wrongly pick up the BN shift
+    assert conv.kernel_size == (1, 1) and conv.groups == 1 and conv.padding == (0, 0)
+    scale, shift = _bn_scale_shift(bn)
+    fused = nn.Conv2d(conv.in_channels, conv.out_channels, 1, conv.stride, padding=0, bias=True).to(conv.weight)
+    bias = conv.bias if conv.bias is not None else torch.zeros(conv.out_channels).to(conv.weight)
+    fused.weight.copy_(conv.weight * scale.reshape(1, -1, 1, 1))
+    fused.bias.copy_(bias + conv.weight.flatten(1) @ shift)
+    return fused
+
+
+def quantize_pointwise_convs(model, calib_inputs, backend='fbgemm'):
+    """ INT8 PTQ of the 1x1 convs on a CPU copy of `model`, calibrated on `calib_inputs` (plain image tensors,
+    not (input, target) tuples). Requires PyTorch >= 1.13 and sets the global torch.backends.quantized.engine.
+    """
+    from torch.ao.quantization import QConfigMapping, get_default_qconfig
+    from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+    qconfig = get_default_qconfig(backend)
+    qconfig_mapping = QConfigMapping()
+    for name, m in model.named_modules():
+        if isinstance(m, nn.Conv2d) and m.kernel_size == (1, 1) and m.groups == 1:
+            qconfig_mapping.set_module_name(name, qconfig)
+    # LayerNorm2d branches on the input memory format and cannot be symbolically traced
+    prepare_custom_config = PrepareCustomConfig().set_non_traceable_module_classes([LayerNorm2d])
+
+    prepared = None
+    with torch.no_grad():
+        for x in calib_inputs:
+            x = x.cpu()
+            if prepared is None:
+                prepared = prepare_fx(model, qconfig_mapping, (x,), prepare_custom_config)
+            prepared(x)
+    assert prepared is not None, 'calib_inputs must yield at least one batch'
+    return convert_fx(prepared)
+
+
 def _conv_filter(state_dict, patch_size=16):
     """ convert patch embedding weight from manual patchify + linear proj to conv"""
     out_dict = {}
@@ -292,7 +390,7 @@ def load_model_weights(model, arch, kwargs):
 def van_tiny(pretrained=False, **kwargs):
     model = VAN(
         embed_dims=[32, 64, 160, 256], mlp_ratios=[8, 8, 4, 4],
-        norm_layer=partial(nn.LayerNorm, eps=1e-6), depths=[3, 3, 5, 2],
+        norm_layer=partial(LayerNorm2d, eps=1e-6), depths=[3, 3, 5, 2],
         **kwargs)
     model.default_cfg = _cfg()
     if pretrained:
@@ -304,7 +402,7 @@ def van_tiny(pretrained=False, **kwargs):
 def van_small(pretrained=False, **kwargs):
     model = VAN(
         embed_dims=[64, 128, 320, 512], mlp_ratios=[8, 8, 4, 4],
-        norm_layer=partial(nn.LayerNorm, eps=1e-6), depths=[2, 2, 4, 2],
+        norm_layer=partial(LayerNorm2d, eps=1e-6), depths=[2, 2, 4, 2],
         **kwargs)
     model.default_cfg = _cfg()
     if pretrained:
@@ -315,7 +413,7 @@ def van_small(pretrained=False, **kwargs):
 def van_base(pretrained=False, **kwargs):
     model = VAN(
         embed_dims=[64, 128, 320, 512], mlp_ratios=[8, 8, 4, 4],
-        norm_layer=partial(nn.LayerNorm, eps=1e-6), depths=[3, 3, 12, 3],
+        norm_layer=partial(LayerNorm2d, eps=1e-6), depths=[3, 3, 12, 3],
         **kwargs)
     model.default_cfg = _cfg()
     if pretrained:
@@ -326,7 +424,7 @@ def van_base(pretrained=False, **kwargs):
 def van_large(pretrained=False, **kwargs):
     model = VAN(
         embed_dims=[64, 128, 320, 512], mlp_ratios=[8, 8, 4, 4],
-        norm_layer=partial(nn.LayerNorm, eps=1e-6), depths=[3, 5, 27, 3],
+        norm_layer=partial(LayerNorm2d, eps=1e-6), depths=[3, 5, 27, 3],
         **kwargs)
     model.default_cfg = _cfg()
     if pretrained:
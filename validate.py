@@ -11,6 +11,7 @@ import argparse
 import os
 import csv
 import glob
+import inspect
 import time
 import logging
 import torch
@@ -18,6 +19,7 @@ import torch.nn as nn
 import torch.nn.parallel
 from collections import OrderedDict
 from contextlib import suppress
+from functools import partial
 
 from timm.models import create_model, apply_test_time_pool, load_checkpoint, is_model, list_models
 from timm.data import create_dataset, create_loader, resolve_data_config, RealLabelsImagenet
@@ -40,6 +42,11 @@ try:
 except AttributeError:
     pass
 
+# autocast gained the dtype and cache_enabled arguments in PyTorch 1.10
+has_autocast_dtype = False
+if has_native_amp:
+    has_autocast_dtype = 'dtype' in inspect.signature(torch.cuda.amp.autocast).parameters
+
 torch.backends.cudnn.benchmark = True
 _logger = logging.getLogger('validate')
 
@@ -95,6 +102,8 @@ parser.add_argument('--channels-last', action='store_true', default=False,
                     help='Use channels_last memory layout')
 parser.add_argument('--amp', action='store_true', default=False,
                     help='Use AMP mixed precision. Defaults to Apex, fallback to native Torch AMP.')
+parser.add_argument('--amp-dtype', default='float16', type=str, choices=['float16', 'bfloat16'],
+                    help='lower precision dtype for native AMP (default: float16)')
 parser.add_argument('--apex-amp', action='store_true', default=False,
                     help='Use NVIDIA Apex AMP mixed precision')
 parser.add_argument('--native-amp', action='store_true', default=False,
@@ -105,6 +114,14 @@ parser.add_argument('--use-ema', dest='use_ema', action='store_true',
                     help='use ema version of weights if present')
 parser.add_argument('--torchscript', dest='torchscript', action='store_true',
                     help='convert model torchscript for inference')
+parser.add_argument('--gelu-tanh', action='store_true', default=False,
+                    help='use the tanh approximation of GELU (faster, slightly different numerics)')
+parser.add_argument('--fuse-bn', dest='fuse_bn', action='store_true',
+                    help='fold BatchNorm layers into adjacent convs before inference')
+parser.add_argument('--torchcompile', action='store_true', default=False,
+                    help='torch.compile the model (mode="reduce-overhead") for inference')
+parser.add_argument('--cuda-graph', action='store_true', default=False,
+                    help='capture the forward pass in a CUDA graph and replay it for full-size batches')
 parser.add_argument('--legacy-jit', dest='legacy_jit', action='store_true',
                     help='use legacy jit mode for pytorch 1.5/1.5.1/1.6 to get back fusion performance')
 parser.add_argument('--results-file', default='', type=str, metavar='FILENAME',
@@ -115,6 +132,37 @@ parser.add_argument('--valid-labels', default='', type=str, metavar='FILENAME',
                     help='Valid label indices txt file for validation of partial label space')
 
 
+class CudaGraphModel:
+    """ Replays a CUDA graph of `model` captured for one input shape, other shapes run eagerly
+    """
+
+    def __init__(self, model, sample_input, amp_autocast=suppress, num_warmup=3):
+        self.model = model
+        self.amp_autocast = amp_autocast
+        self.static_input = sample_input.clone()
+
+        # warm up on a side stream before capture, as required by torch.cuda.graph
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream), amp_autocast():
+            for _ in range(num_warmup):
+                model(self.static_input)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph), amp_autocast():
+            self.static_output = model(self.static_input)
+
+    def __call__(self, x):
+        if x.shape != self.static_input.shape:
+            # e.g. the last, partial batch of the loader
+            with self.amp_autocast():
+                return self.model(x)
+        self.static_input.copy_(x)
+        self.graph.replay()
+        return self.static_output.clone()
+
+
 def validate(args):
     # might as well try to validate something
     args.pretrained = args.pretrained or not args.checkpoint
@@ -128,9 +176,16 @@ def validate(args):
         else:
             _logger.warning("Neither APEX or Native Torch AMP is available.")
     assert not args.apex_amp or not args.native_amp, "Only one AMP mode should be set."
+    assert args.amp_dtype == 'float16' or args.native_amp, '--amp-dtype {} requires native AMP'.format(args.amp_dtype)
     if args.native_amp:
         amp_autocast = torch.cuda.amp.autocast
-        _logger.info('Validating in mixed precision with native PyTorch AMP.')
+        if args.amp_dtype != 'float16':
+            assert has_autocast_dtype, '--amp-dtype {} requires PyTorch 1.10 or newer'.format(args.amp_dtype)
+            amp_autocast = partial(amp_autocast, dtype=getattr(torch, args.amp_dtype))
+        if args.cuda_graph:
+            # the autocast weight cache does not survive CUDA graph capture
+            amp_autocast = partial(amp_autocast, cache_enabled=False)
+        _logger.info('Validating in mixed precision ({}) with native PyTorch AMP.'.format(args.amp_dtype))
     elif args.apex_amp:
         _logger.info('Validating in mixed precision with NVIDIA APEX AMP.')
     else:
@@ -140,13 +195,18 @@ def validate(args):
         set_jit_legacy()
 
     # create model
+    model_kwargs = {}
+    if args.gelu_tanh:
+        assert 'approximate' in inspect.signature(nn.GELU).parameters, '--gelu-tanh requires PyTorch 1.12 or newer'
+        model_kwargs['act_layer'] = partial(nn.GELU, approximate='tanh')
     model = create_model(
         args.model,
         pretrained=args.pretrained,
         num_classes=args.num_classes,
         in_chans=3,
         global_pool=args.gp,
-        scriptable=args.torchscript)
+        scriptable=args.torchscript,
+        **model_kwargs)
     if args.num_classes is None:
         assert hasattr(model, 'num_classes'), 'Model must have `num_classes` attr if not set on cmd line/config.'
         args.num_classes = model.num_classes
@@ -157,6 +217,10 @@ def validate(args):
     param_count = sum([m.numel() for m in model.parameters()])
     _logger.info('Model %s created, param count: %d' % (args.model, param_count))
 
+    if args.fuse_bn:
+        assert hasattr(model, 'fuse_for_inference'), '--fuse-bn is only supported for VAN models'
+        model.fuse_for_inference()
+
     data_config = resolve_data_config(vars(args), model=model, use_test_size=True, verbose=True)
     test_time_pool = False
     if args.test_pool:
@@ -173,6 +237,17 @@ def validate(args):
     if args.channels_last:
         model = model.to(memory_format=torch.channels_last)
 
+    if args.torchcompile:
+        assert not args.torchscript, 'Cannot use torch.compile with a torchscripted model'
+        assert hasattr(torch, 'compile'), 'torch.compile requires PyTorch 2.0 or newer'
+        model = torch.compile(model, mode='reduce-overhead', fullgraph=False, dynamic=False)
+
+    if args.cuda_graph:
+        assert hasattr(torch.cuda, 'graph'), 'CUDA graph capture requires PyTorch 1.10 or newer'
+        assert not args.torchcompile, 'torch.compile reduce-overhead mode already uses CUDA graphs'
+        assert not args.apex_amp, 'Cannot capture CUDA graphs with APEX AMP'
+        assert args.num_gpu == 1, 'CUDA graph capture only supports a single GPU'
+
     if args.num_gpu > 1:
         model = torch.nn.DataParallel(model, device_ids=list(range(args.num_gpu)))
 
@@ -224,7 +299,11 @@ def validate(args):
         input = torch.randn((args.batch_size,) + tuple(data_config['input_size'])).cuda()
         if args.channels_last:
             input = input.contiguous(memory_format=torch.channels_last)
-        model(input)
+        if args.cuda_graph:
+            model = CudaGraphModel(model, input, amp_autocast=amp_autocast)
+        else:
+            with amp_autocast():
+                model(input)
         end = time.time()
         for batch_idx, (input, target) in enumerate(loader):
             if args.no_prefetcher: